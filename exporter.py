@@ -6,7 +6,10 @@ import argparse
 import urllib.request
 import zipfile
 import platform
-import math
+import threading
+import bisect
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # ------------------------ Auto Install ------------------------
 
@@ -14,20 +17,104 @@ def pip_install(package):
     subprocess.check_call([sys.executable, "-m", "pip", "install", package])
 
 try:
-    from pydub import AudioSegment
+    import numpy as np
 except ImportError:
-    pip_install("pydub")
-    from pydub import AudioSegment
+    pip_install("numpy")
+    import numpy as np
+
+try:
+    import soundfile as sf
+except ImportError:
+    pip_install("soundfile")
+    import soundfile as sf
+
+try:
+    from scipy.signal import resample_poly
+except ImportError:
+    pip_install("scipy")
+    from scipy.signal import resample_poly
 
 # ------------------------ FFmpeg Setup ------------------------
 
 def set_status(name, rel):
     print(f"{name}${rel}", flush=True)
 
-def download_progress(count, block_size, total_size):
-    downloaded = count * block_size
-    percent = int(min(1, downloaded / total_size))
-    set_status("download", percent)
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_BLOCK_SIZE = 64 * 1024
+FFMPEG_BIN_CACHE = ".ffmpeg_bin_path"
+
+def download_progress(total_size):
+    # Thread-safe callback fed with byte counts; reports the 0..1 fraction to 2 decimals,
+    # only when it changes (unknown sizes are skipped)
+    lock = threading.Lock()
+    state = {"downloaded": 0, "reported": None}
+
+    def advance(size):
+        with lock:
+            state["downloaded"] += size
+            if total_size <= 0:
+                return
+            value = round(min(1, state["downloaded"] / total_size), 2)
+            if value != state["reported"]:
+                state["reported"] = value
+                set_status("download", value)
+
+    return advance
+
+def copy_blocks(resp, f, progress):
+    while True:
+        block = resp.read(DOWNLOAD_BLOCK_SIZE)
+        if not block:
+            break
+        f.write(block)
+        progress(len(block))
+
+def download_file(url, path):
+    # Downloads into a ".part" file so an interrupted run is never taken as complete
+    part_path = path + ".part"
+
+    # Probed with a one-byte range GET rather than HEAD (urllib turns a redirected HEAD into
+    # a full GET); a 206 proves range support and carries the size in Content-Range.
+    # A server that ignores the range answers 200 with the whole file, which is kept.
+    with urllib.request.urlopen(urllib.request.Request(url, headers={"Range": "bytes=0-0"})) as resp:
+        url = resp.url
+        total_size = resp.headers.get("Content-Range", "").rpartition("/")[2]
+        ranged = resp.status == 206
+        if not ranged:
+            with open(part_path, "wb") as f:
+                copy_blocks(resp, f, download_progress(int(resp.headers.get("Content-Length") or 0)))
+
+    if ranged and not total_size.isdigit():
+        with urllib.request.urlopen(url) as resp, open(part_path, "wb") as f:
+            copy_blocks(resp, f, download_progress(int(resp.headers.get("Content-Length") or 0)))
+        ranged = False
+
+    if not ranged:
+        os.replace(part_path, path)
+        return
+
+    # Fetch byte ranges in parallel straight into their place in a preallocated file
+    total_size = int(total_size)
+    with open(part_path, "wb") as f:
+        f.truncate(total_size)
+
+    progress = download_progress(total_size)
+
+    def fetch_range(first, last):
+        request = urllib.request.Request(url, headers={"Range": f"bytes={first}-{last}"})
+        with urllib.request.urlopen(request) as resp, open(part_path, "r+b") as f:
+            if resp.status != 206:
+                raise OSError(f"Server ignored range request for {url}")
+            f.seek(first)
+            copy_blocks(resp, f, progress)
+
+    chunk_size = -(-total_size // DOWNLOAD_WORKERS)
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        futures = [pool.submit(fetch_range, first, min(first + chunk_size, total_size) - 1)
+                   for first in range(0, total_size, chunk_size)]
+        for future in futures:
+            future.result()
+    os.replace(part_path, path)
 
 def download_and_extract_ffmpeg(dest_folder):
     ffmpeg_url = "https://www.gyan.dev/ffmpeg/builds/ffmpeg-release-essentials.zip"
@@ -35,7 +122,7 @@ def download_and_extract_ffmpeg(dest_folder):
     zip_path = os.path.join(dest_folder, "ffmpeg.zip")
 
     if not os.path.isfile(zip_path):
-        urllib.request.urlretrieve(ffmpeg_url, zip_path, reporthook=download_progress)
+        download_file(ffmpeg_url, zip_path)
 
     extracted_dir = next((d for d in os.listdir(dest_folder) if d.startswith("ffmpeg-")), None)
     if not extracted_dir:
@@ -48,17 +135,232 @@ def download_and_extract_ffmpeg(dest_folder):
 
     return os.path.join(dest_folder, extracted_dir, "bin")
 
+def cached_ffmpeg_bin(dest_folder):
+    # Bin path recorded by a previous install, if it still holds ffmpeg.exe
+    try:
+        with open(os.path.join(dest_folder, FFMPEG_BIN_CACHE), "r", encoding="utf-8") as f:
+            ffmpeg_bin = f.read().strip()
+    except OSError:
+        return None
+    return ffmpeg_bin if os.path.isfile(os.path.join(ffmpeg_bin, "ffmpeg.exe")) else None
+
 def check_and_setup_ffmpeg():
     if shutil.which("ffmpeg"):
         return
     if platform.system().lower() != "windows":
         sys.exit(1)
     ffmpeg_local_dir = os.path.join(os.path.dirname(__file__), "ffmpeg")
-    ffmpeg_bin = download_and_extract_ffmpeg(ffmpeg_local_dir)
+    ffmpeg_bin = cached_ffmpeg_bin(ffmpeg_local_dir)
+    if not ffmpeg_bin:
+        ffmpeg_bin = download_and_extract_ffmpeg(ffmpeg_local_dir)
+        with open(os.path.join(ffmpeg_local_dir, FFMPEG_BIN_CACHE), "w", encoding="utf-8") as f:
+            f.write(ffmpeg_bin)
     os.environ["PATH"] = ffmpeg_bin + os.pathsep + os.environ.get("PATH", "")
     if not shutil.which("ffmpeg"):
         sys.exit(1)
 
+# ------------------------ Decoding ------------------------
+
+def probe_format(file):
+    # (sample rate, channels) of the first audio stream, in-process when libsndfile can open it
+    try:
+        info = sf.info(file)
+        return info.samplerate, info.channels
+    except RuntimeError:
+        pass
+    cmd = ["ffprobe", "-v", "error", "-select_streams", "a:0",
+           "-show_entries", "stream=sample_rate,channels", "-of", "default=nw=1", file]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, check=True, text=True)
+    info = dict(line.split("=", 1) for line in proc.stdout.split())
+    return int(info["sample_rate"]), int(info["channels"])
+
+def match_channels(samples, src_channels, channels):
+    # A mono mix averages the source channels and a mono source is duplicated to every
+    # channel (pydub's rule); returns None for other layouts, which ffmpeg rematrixes
+    if src_channels == channels:
+        return samples
+    if channels == 1:
+        return samples.mean(axis=1, keepdims=True, dtype=np.float32)
+    if src_channels == 1:
+        return np.repeat(samples, channels, axis=1)
+    return None
+
+def decode_window(file, start, duration, sr, channels):
+    # Decoded from the start and cut by sample index, as (frames, channels) in the mix format.
+    # Input-side -ss is not sample-accurate on Vorbis, so -t (with a 1 s margin) is only used
+    # to stop reading early; mix_with_ffmpeg windows its inputs the same way.
+    src_channels = probe_format(file)[1]
+    decode_channels = src_channels if 1 in (src_channels, channels) else channels
+    cmd = ["ffmpeg", "-v", "quiet",
+           "-t", f"{start + duration + 1:.6f}", "-i", file,
+           "-f", "s16le", "-ac", str(decode_channels), "-ar", str(sr), "pipe:1"]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, check=True)
+    first = int(start * sr)
+    samples = np.frombuffer(proc.stdout, dtype=np.int16).reshape(-1, decode_channels)
+    return match_channels(samples[first:first + int(duration * sr)], decode_channels, channels)
+
+def read_window(file, start, duration, sr, channels):
+    # Decoded in-process by libsndfile/libvorbis when it can open the file, so there is no
+    # ffmpeg process per file; returns (frames, channels) samples and their sample rate
+    try:
+        with sf.SoundFile(file) as f:
+            if f.channels == channels or 1 in (f.channels, channels):
+                f.seek(min(int(start * f.samplerate), f.frames))
+                samples = f.read(int(duration * f.samplerate), dtype="int16", always_2d=True)
+                return match_channels(samples, f.channels, channels), f.samplerate
+    except RuntimeError:
+        pass
+    return decode_window(file, start, duration, sr, channels), sr
+
+def resample(samples, ratio):
+    # Polyphase resample by ratio (output / input rate); pitch and rate conversion in one pass
+    ratio = Fraction(ratio).limit_denominator(1000)
+    samples = samples.astype(np.float32)
+    if ratio == 1 or len(samples) == 0:
+        return samples
+    return resample_poly(samples, ratio.numerator, ratio.denominator, axis=0)
+
+def render_file(file, uses, sr, channels):
+    # Pitches are quantized to 3 decimals once, so the decode window, the per-pitch spans and
+    # the resample ratios all use the same value
+    uses = [(pos, start, length, gain, max(round(pitch, 3), 0.001)) for pos, start, length, gain, pitch in uses]
+
+    # The union of all source windows of a file is decoded once, whatever the pitches.
+    # Start and length are pitch-affected, so a use covers start * pitch .. (start + length) * pitch
+    # of the source.
+    window_start = min(start * pitch for _, start, _, _, pitch in uses)
+    window_end = max((start + length) * pitch for _, start, length, _, pitch in uses)
+    source, rate = read_window(file, window_start, window_end - window_start, sr, channels)
+    source_first = int(window_start * rate)
+
+    uses_by_pitch = {}
+    for use in uses:
+        uses_by_pitch.setdefault(use[4], []).append(use)
+
+    # Resampled once per pitch over the span its uses need; each use is then just a view into
+    # the pitched buffer. Sample indices are floored once from absolute times, so the
+    # offsets into the window and into the span cannot drift apart by a sample.
+    result = []
+    for pitch, pitch_uses in uses_by_pitch.items():
+        span_start = min(start for _, start, _, _, _ in pitch_uses)
+        span_end = max(start + length for _, start, length, _, _ in pitch_uses)
+        first = max(int(span_start * pitch * rate) - source_first, 0)
+        last = max(int(span_end * pitch * rate) - source_first, first)
+        pitched = resample(source[first:last], sr / (pitch * rate))
+        for pos, start, length, gain, _ in pitch_uses:
+            begin = int(start * sr) - int(span_start * sr)
+            result.append((pos, gain, pitched[begin:begin + int(length * sr)]))
+    return result
+
+# ------------------------ Mixing ------------------------
+
+FFMPEG_MIX_MAX_INPUTS = 30
+SILENCE_BLOCK = bytes(1024 * 1024)
+
+def channel_filter(src_channels, channels):
+    # Filtergraph form of match_channels (None there becomes ffmpeg's standard rematrix)
+    layout = {1: "mono", 2: "stereo"}.get(channels, f"{channels}c")
+    if src_channels == channels:
+        return ""
+    if channels == 1:
+        return "pan=mono|c0=" + "+".join(f"{1 / src_channels:.6g}*c{k}" for k in range(src_channels)) + ","
+    if src_channels == 1:
+        return f"pan={layout}|" + "|".join(f"c{k}=c0" for k in range(channels)) + ","
+    return f"aformat=channel_layouts={layout},"
+
+def mix_with_ffmpeg(placements, sr, channels, total_samples, output):
+    # A single ffmpeg run: each input is resampled to sr / pitch, windowed by sample index
+    # with atrim (see decode_window), relabelled as sr to apply the pitch, then scaled,
+    # delayed to its offset and summed by amix without normalization
+    cmd = ["ffmpeg", "-v", "quiet", "-y"]
+    chains = []
+    for i, (file, offset, start, length, volume, pitch) in enumerate(placements):
+        cmd += ["-t", f"{(start + length) * pitch + 1:.6f}", "-i", file]
+        rate = int(round(sr / pitch))
+        first = int(start * pitch * rate)
+        delay = "|".join([f"{int(offset * sr)}S"] * channels)
+        chains.append(f"[{i}:a]aresample={rate},atrim=start_sample={first}:end_sample={first + int(length * sr)},"
+                      f"asetpts=PTS-STARTPTS,asetrate={sr},{channel_filter(probe_format(file)[1], channels)}"
+                      f"volume={volume},adelay={delay}[a{i}]")
+    inputs = "".join(f"[a{i}]" for i in range(len(placements)))
+    # Padded/trimmed to the estimated duration; s16 clips like the Python mix does
+    chains.append(f"{inputs}amix=inputs={len(placements)}:normalize=0:duration=longest,"
+                  f"apad=whole_len={total_samples},atrim=end_sample={total_samples},aformat=sample_fmts=s16[out]")
+    cmd += ["-filter_complex", ";".join(chains), "-map", "[out]", "-c:a", "libvorbis", output]
+
+    set_status("export", 1)
+    subprocess.run(cmd, check=True)
+
+def plan_islands(spans, total_samples, channels):
+    # Overlapping or touching spans are merged, so the mix only allocates where there is sound.
+    # float32 keeps the sums SIMD-friendly and cannot overflow; it is saturated once at export.
+    merged = []
+    for start, end in sorted(spans):
+        end = min(end, total_samples)
+        if start >= end:
+            continue
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [(start, np.zeros((end - start, channels), dtype=np.float32)) for start, end in merged]
+
+def write_silence(stream, size):
+    while size > 0:
+        block = min(size, len(SILENCE_BLOCK))
+        stream.write(SILENCE_BLOCK[:block])
+        size -= block
+
+def mix_with_numpy(placements, sr, channels, total_samples, output):
+    # Per-use sample positions and gains are converted once, as arrays, outside the hot loop.
+    # The gain is the linear volume scaled from int16 to -1..1 full scale.
+    files, offsets, starts, lengths, volumes, pitches = zip(*placements)
+    positions = (np.asarray(offsets) * sr).astype(np.int64)
+    ends = positions + (np.asarray(lengths) * sr).astype(np.int64)
+    gains = np.asarray(volumes, dtype=np.float32) / np.float32(32768)
+
+    islands = plan_islands(zip(positions.tolist(), ends.tolist()), total_samples, channels)
+    island_starts = [start for start, _ in islands]
+
+    uses_by_file = {}
+    for file, pos, start, length, gain, pitch in zip(files, positions.tolist(), starts, lengths, gains, pitches):
+        uses_by_file.setdefault(file, []).append((pos, start, length, gain, pitch))
+
+    # Decode and pitch in parallel (libvorbis/ffmpeg and scipy do the work), mix in this
+    # thread as results arrive; all uses of a file are mixed while its renders are still hot
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        futures = [pool.submit(render_file, file, uses, sr, channels) for file, uses in uses_by_file.items()]
+        for future in as_completed(futures):
+            for pos, gain, samples in future.result():
+                if len(samples) == 0 or pos >= total_samples:
+                    continue
+                island_start, island = islands[bisect.bisect_right(island_starts, pos) - 1]
+                pos -= island_start
+
+                # Scale by the gain and add into its island in one pass (cropped to the mix length)
+                segment = samples[:len(island) - pos]
+                island[pos:pos + len(segment)] += np.multiply(segment, gain, dtype=np.float32)
+
+    # Raw float PCM is streamed into the encoder island by island, with the gaps written
+    # from a shared block of zeros; no temporary WAV file and no full-length buffer.
+    # Each island is saturated in place and written as-is, with no int16 copy.
+    set_status("export", 1)
+    cmd = ["ffmpeg", "-v", "quiet", "-y",
+           "-f", "f32le", "-ar", str(sr), "-ac", str(channels), "-i", "pipe:0",
+           "-c:a", "libvorbis", output]
+    frame_size = 4 * channels
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    written = 0
+    for island_start, island in islands:
+        write_silence(proc.stdin, (island_start - written) * frame_size)
+        np.clip(island, -1.0, 1.0, out=island)
+        proc.stdin.write(island)
+        written = island_start + len(island)
+    write_silence(proc.stdin, (total_samples - written) * frame_size)
+    proc.stdin.close()
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
 # ------------------------ Main Logic ------------------------
 
 def main():
@@ -80,41 +382,24 @@ def main():
             == len(args.volumes) == len(args.pitches)):
         parser.error("All argument lists must be the same length.")
 
-    # Estimate final duration (since slower pitch increases it)
-    est_end_times = []
-    for off, start, length, pitch in zip(args.offsets, args.starts, args.lengths, args.pitches):
-        pitch = max(pitch, 1e-8)
-        duration_stretched = length / pitch
-        est_end_times.append(off + duration_stretched)
-    total_end_ms = int(max(est_end_times) * 1000)
+    volumes = np.maximum(np.asarray(args.volumes, dtype=np.float64), 1e-8)
+    pitches = np.maximum(np.asarray(args.pitches, dtype=np.float64), 1e-8)
 
-    final_mix = AudioSegment.silent(duration=total_end_ms)
-
-    for file, offset, start, length, volume, pitch in zip(args.files, args.offsets, args.starts, args.lengths, args.volumes, args.pitches):
-        volume = max(volume, 1e-8)
-        pitch = max(pitch, 1e-8)
-
-        # Load original audio
-        audio = AudioSegment.from_ogg(file)
-
-        # Apply pitch (by modifying playback speed)
-        new_frame_rate = int(audio.frame_rate * pitch)
-        pitched = audio._spawn(audio.raw_data, overrides={"frame_rate": new_frame_rate})
-
-        # Crop after pitch shift (start and length are in seconds)
-        start_ms = int(start * 1000)
-        length_ms = int(length * 1000)
-        segment = pitched[start_ms:start_ms + length_ms]
+    # Estimate final duration (since slower pitch increases it)
+    total_end_ms = int(np.max(np.asarray(args.offsets) + np.asarray(args.lengths) / pitches) * 1000)
 
-        # Adjust volume
-        gain_db = 20 * math.log10(volume)
-        segment = segment + gain_db
+    # Mix in the format of the first file; every segment is converted to it
+    sr, channels = probe_format(args.files[0])
+    total_samples = int(total_end_ms * sr / 1000)
 
-        # Mix into the final audio
-        final_mix = final_mix.overlay(segment, position=int(offset * 1000))
+    placements = list(zip(args.files, args.offsets, args.starts, args.lengths, volumes.tolist(), pitches.tolist()))
 
-    set_status("export", 1)
-    final_mix.export(args.output, format="ogg", codec="libvorbis")
+    # Small mixes run entirely inside ffmpeg; larger ones would exceed command-line
+    # limits, so they are decoded and summed in NumPy instead
+    if len(placements) <= FFMPEG_MIX_MAX_INPUTS:
+        mix_with_ffmpeg(placements, sr, channels, total_samples, args.output)
+    else:
+        mix_with_numpy(placements, sr, channels, total_samples, args.output)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
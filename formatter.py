@@ -1,4 +1,4 @@
-import sys, os, argparse, subprocess, shutil, platform, math, urllib.request, zipfile
+import sys, os, io, argparse, subprocess, shutil, platform, math, urllib.request, zipfile
 import numpy as np
 
 def pip_install(pkg):
@@ -6,10 +6,16 @@ def pip_install(pkg):
 
 # Ensure lib dependencies
 try:
-    import librosa
+    import soundfile as sf
 except ImportError:
-    pip_install("librosa")
-    import librosa
+    pip_install("soundfile")
+    import soundfile as sf
+
+try:
+    import numba
+except ImportError:
+    pip_install("numba")
+    import numba
 
 # Optional - if ffmpeg not installed (common on Windows), bundle download
 def download_and_extract_ffmpeg(dest):
@@ -23,26 +29,78 @@ def download_and_extract_ffmpeg(dest):
     sub = next(d for d in os.listdir(dest) if d.startswith("ffmpeg-"))
     return os.path.join(dest, sub, "bin")
 
+def cached_ffmpeg_bin(dest):
+    # Bin path recorded by a previous install, if it still holds ffmpeg.exe
+    try:
+        with open(os.path.join(dest, ".ffmpeg_bin_path"), "r", encoding="utf-8") as f:
+            bindir = f.read().strip()
+    except OSError:
+        return None
+    return bindir if os.path.isfile(os.path.join(bindir, "ffmpeg.exe")) else None
+
 def check_and_setup_ffmpeg():
     if shutil.which("ffmpeg"):
         return
     if platform.system().lower() != "windows":
         return
-    bindir = download_and_extract_ffmpeg(os.path.join(os.path.dirname(__file__), "ffmpeg"))
+    dest = os.path.join(os.path.dirname(__file__), "ffmpeg")
+    bindir = cached_ffmpeg_bin(dest)
+    if not bindir:
+        bindir = download_and_extract_ffmpeg(dest)
+        with open(os.path.join(dest, ".ffmpeg_bin_path"), "w", encoding="utf-8") as f:
+            f.write(bindir)
     os.environ["PATH"] = bindir + os.pathsep + os.environ.get("PATH", "")
 
 def set_status(line):
     print(line, flush=True)
 
+def load_mono(path):
+    """Load audio as int32 mono samples at the native rate (ffmpeg for formats libsndfile can't read)."""
+    try:
+        data, sr = sf.read(path, dtype="int16", always_2d=True)
+        return data.sum(axis=1, dtype=np.int32) // data.shape[1], sr
+    except RuntimeError:
+        pass
+    probe = subprocess.run(["ffprobe", "-v", "error", "-select_streams", "a:0", "-show_entries", "stream=sample_rate",
+                            "-of", "default=nw=1:nk=1", path], stdout=subprocess.PIPE, check=True)
+    pcm = subprocess.run(["ffmpeg", "-v", "quiet", "-i", path, "-f", "s16le", "-ac", "1", "pipe:1"],
+                         stdout=subprocess.PIPE, check=True)
+    return np.frombuffer(pcm.stdout, dtype=np.int16).astype(np.int32), int(probe.stdout)
+
 def robust_trim(y, sr, enable_trim=True, top_db=60, frame_length=1024, hop_length=256):
-    """Optionally trim leading/trailing low-energy regions using librosa.effects.trim."""
+    """Optionally trim leading/trailing low-energy regions (same rule as librosa.effects.trim)."""
     if not enable_trim:
         return y
-    # librosa.effects.trim: trims segments top_db dB below max RMS; tweak hop_length for precision.
-    yt, _ = librosa.effects.trim(
-        y, top_db=top_db, frame_length=frame_length, hop_length=hop_length
-    )
-    return yt if yt.size > 0 else y
+    # Centered frames: the power is zero-padded by frame_length // 2 on both sides and
+    # each frame's energy is read off an exact int64 cumulative sum.
+    pad = frame_length // 2
+    cumsum = np.zeros(y.size + 2 * pad + 1, dtype=np.int64)
+    np.cumsum(np.square(y, dtype=np.int64), out=cumsum[pad + 1:pad + 1 + y.size])
+    cumsum[pad + 1 + y.size:] = cumsum[pad + y.size]
+    n_frames = 1 + (y.size + 2 * pad - frame_length) // hop_length
+    frame_starts = hop_length * np.arange(n_frames, dtype=np.int64)
+    mse = (cumsum[frame_starts + frame_length] - cumsum[frame_starts]) / frame_length
+
+    # Frames within top_db of the loudest one are kept (amin matches librosa's 1e-10 on a 0..1 scale).
+    mse = np.maximum(mse, 1e-10 * 32768.0 ** 2)
+    frames = np.flatnonzero(mse > mse.max() * 10.0 ** (-top_db / 10.0))
+    if frames.size == 0:
+        return y
+    return y[frames[0] * hop_length:min(y.size, (frames[-1] + 1) * hop_length)]
+
+# Explicit signature: compiled eagerly for the exact types main() passes, so cache=True
+# reloads it from disk on later runs instead of JIT-compiling on the first call.
+@numba.njit("void(int32[::1], int64, float64[::1])", parallel=True, fastmath=True, cache=True)
+def rms_bucket(y, spacing, out):
+    """Exact RMS of each spacing-sized interval of y into out (int64 sums, intervals in parallel)."""
+    for i in numba.prange(out.size):
+        start = i * spacing
+        end = min(start + spacing, y.size)
+        acc = 0
+        for j in range(start, end):
+            v = np.int64(y[j])
+            acc += v * v
+        out[i] = np.sqrt(acc / max(end - start, 1))
 
 def main():
     check_and_setup_ffmpeg()
@@ -54,35 +112,24 @@ def main():
     parser.add_argument("--trim-db", type=float, default=60.0, help="Top dB below max to consider silence for trimming (default 60)")
     args = parser.parse_args()
 
-    # 1) Load at native rate, mono (librosa uses soundfile when possible; otherwise audioread/ffmpeg).
-    # Keep sr=None to avoid resampling (less edge funk). Docs: librosa.load. 
-    y, sr = librosa.load(args.input, sr=None, mono=True)
+    # 1) Load at native rate, mono, as integers (soundfile when possible; otherwise ffmpeg).
+    # No resampling (less edge funk) and no float conversion until the final sqrt.
+    y, sr = load_mono(args.input)
 
     # 2) (Optional) Trim low-energy leading/trailing chunks to remove codec padding artifacts.
     # This handles typical priming/decoder silence and repeated patterns at edges.
-    # See librosa.effects.trim docs.
     y = robust_trim(y, sr, enable_trim=not args.no_trim, top_db=args.trim_db, frame_length=1024, hop_length=256)
 
     if y.size == 0:
         set_status("")  # empty
         return
 
-    # 3) Compute per-sample power and cumulative sum (double precision for stability).
-    power = y.astype(np.float64) ** 2
-    cumsum = np.concatenate(([0.0], np.cumsum(power)))
-
-    # 4) Exact, bucketed RMS using cumulative sums (no fencepost errors).
+    # 3) Exact, bucketed RMS: one compiled parallel pass, each interval summing its own
+    # int64 power (no fencepost errors, no float until the sqrt).
     spacing_samples = max(int(round(args.spacing * sr)), 1)
     n_intervals = int(math.ceil(len(y) / spacing_samples))
-
-    starts = spacing_samples * np.arange(n_intervals, dtype=np.int64)
-    ends = np.minimum(starts + spacing_samples, len(y)).astype(np.int64)
-
-    sums = cumsum[ends] - cumsum[starts]
-    lengths = (ends - starts).astype(np.float64)
-    # Guard against any zero-length (shouldn't happen, but be safe)
-    lengths = np.maximum(lengths, 1.0)
-    rms = np.sqrt(sums / lengths)
+    rms = np.empty(n_intervals, dtype=np.float64)
+    rms_bucket(y, spacing_samples, rms)
 
     # Normalize to 0..1
     max_r = float(np.max(rms)) if rms.size else 1.0
@@ -91,7 +138,10 @@ def main():
     else:
         normalized = np.minimum(rms / max_r, 1.0)
 
-    set_status(" ".join(f"{v:.5f}" for v in normalized))
+    # One row through np.savetxt: a single %-format of the whole row instead of N f-string calls
+    buf = io.BytesIO()
+    np.savetxt(buf, normalized.reshape(1, -1), fmt="%.5f", delimiter=" ")
+    set_status(buf.getvalue().decode().rstrip())
 
 if __name__ == "__main__":
     main()